@@ -2,46 +2,91 @@
 Watches the starmen.net forum spy for new posts, and posts them into #forum-spy
 on the official discord server.
 """
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import html
+import importlib.util
 import json
+import math
 import os
+import random
+import re
+import signal
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
-import urllib.request
+import urllib.parse
 
-from bs4 import BeautifulSoup
-import discord
+
+def _lazy_import(name):
+    """
+    Imports a module the first time one of its attributes gets used, rather than right away.
+    aiohttp and bs4 take a while to import, and plenty of uses of this module (like test_spy.py)
+    never need one or the other.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+aiohttp = _lazy_import("aiohttp")
+bs4 = _lazy_import("bs4")
 
 
 # # # # #
 # Config variables
 # # # # #
 
-webhook_url_general = os.getenv("FORUM_SPY_DISCORD_WEBHOOK_URL")
-if not webhook_url_general:
-    print("ERROR: Environment variable FORUM_SPY_DISCORD_WEBHOOK_URL must be set!")
-    sys.exit()
+# Settings that can be tuned per deployment are only defaults here, see Config.
 
-webhook_url_mafia = os.getenv("FORUM_SPY_DISCORD_WEBHOOK_URL_MAFIA")
-if not webhook_url_mafia:
-    print("ERROR: Environment variable FORUM_SPY_DISCORD_WEBHOOK_URL_MAFIA must be set!")
-    sys.exit()
-
-DISCORD_WEBHOOK_GENERAL = discord.Webhook.from_url(
-    webhook_url_general, adapter=discord.RequestsWebhookAdapter()
-)
-DISCORD_WEBHOOK_MAFIA = discord.Webhook.from_url(
-    webhook_url_mafia, adapter=discord.RequestsWebhookAdapter()
-)
-DISCORD_NO_MENTIONS = discord.AllowedMentions(everyone=False, users=False, roles=False)
+DISCORD_NO_MENTIONS = {"parse": []}
+# Webhook requests share a pool of keep-alive connections to Discord, like forum requests do
+DISCORD_POOL_SIZE = 4
+DISCORD_POOL_IDLE_TIMEOUT = 60
+# Posts waiting to go to the same webhook are sent together, as long as the message stays within
+# Discord's limits on embeds per message and on characters across all of them.
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_EMBED_CHARS = 6000
+# How long to wait before retrying a webhook request that failed for some reason other than
+# Discord's rate limit (rate limited requests wait exactly as long as Discord asks them to)
+DISCORD_RETRY_INTERVAL = 5
 
 FORUM_ROOT = "https://forum.starmen.net"
 FORUM_SPY_AJAX = FORUM_ROOT + "/forum/spy.ajax"
+# The post HTML in the spy data compresses very well, so ask for it compressed. aiohttp decompresses
+# responses transparently, but it can only handle brotli if the brotli module is installed.
+FORUM_ACCEPT_ENCODING = (
+    "gzip, deflate, br" if importlib.util.find_spec("brotli") is not None else "gzip, deflate"
+)
 FORUM_SPY_REQUEST_HEADERS = {
     "Accept": "*/*",
+    "Accept-Encoding": FORUM_ACCEPT_ENCODING,
     "Referer": "https://forum.starmen.net/forum/spy",
     "User-Agent": "discord-forum-spy-bot",
 }
+# Forum requests share a pool of keep-alive connections, so the steady-state poll reuses one warm
+# connection instead of paying for a new TCP/TLS handshake every time. Idle connections are kept
+# for longer than the poll interval so they survive from one poll to the next.
+FORUM_POOL_SIZE = 4
+FORUM_POOL_IDLE_TIMEOUT = 60
 FORUM_PREVIEW_LENGTH = 250
+
+# Which BeautifulSoup tree builder parses forum HTML: "lxml", "html5lib" or "html.parser".
+# lxml is much faster than the others, so it's the default when it's installed.
+# (checked when the main loop starts, see forum_spy_loop)
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
 FORUM_COLOR_EVEN = int(0x010B17)
 FORUM_COLOR_ODD = int(0x001228)
 
@@ -55,12 +100,104 @@ MAFIA_BOARDS = [
     "/forum/Community/mafiB",
 ]
 
+# Where posts go, by name: each destination has a webhook_url, and the boards it subscribes to (see
+# _destinations). None configured means the usual two, general and mafia, using the settings above.
+DESTINATIONS = {}
+
+# How long to wait between forum spy polls. We start out at the forum spy's own 15 seconds, then
+# speed up while posts keep coming in (so busy periods don't scroll posts out of the spy window)
+# and back off while it's quiet. Errors back off from 30 seconds. Every wait gets some jitter.
+POLL_INTERVAL = 15
+POLL_INTERVAL_MIN = 5
+POLL_INTERVAL_MAX = 120
+POLL_ERROR_INTERVAL = 30
+POLL_JITTER = 0.1
+
+# How many posts may be waiting to be parsed before the fetch worker blocks?
+# (the spy window is much smaller than this, so in practice it never fills up)
+PARSE_QUEUE_SIZE = 100
+
+# How many posts to parse at once, each in a process of its own. Parsing is CPU-bound, so this lets
+# catching up on a backlog of posts use more than one core. 0 parses one post at a time in a thread.
+PARSE_WORKERS = 0
+
+# Where we keep track of the newest post we've finished with, so a restart can pick up where we
+# left off. It's written at most this often (in seconds) rather than after every single post.
+STATE_FILE = "forum_spy_state.json"
+CHECKPOINT_INTERVAL = 5
+
+# Parsed posts wait in this SQLite database until Discord has them, so a restart or a Discord outage
+# only delays them. If sending keeps failing, we try again after a while, backing off up to the max.
+OUTBOX_FILE = "forum_spy_outbox.sqlite3"
+OUTBOX_RETRY_INTERVAL = 30
+OUTBOX_RETRY_INTERVAL_MAX = 10 * 60
+
+# Names of members with avatars are remembered for a while, so we don't have to look up their
+# profile for every post. Failed lookups are remembered for a shorter time. Give them a file to keep
+# them across restarts (saved along with the state file).
+USERNAME_CACHE_SIZE = 500
+USERNAME_CACHE_TTL = 6 * 60 * 60
+USERNAME_CACHE_ERROR_TTL = 5 * 60
+USERNAME_CACHE_FILE = None
+
+# If more posts come in between polls than the spy window holds, the ones that fell off it are
+# fetched one by one from their message pages instead. We only go this far back, with this many
+# requests at once, and this many requests per second at most.
+BACKFILL_LIMIT = 100
+BACKFILL_CONCURRENCY = 3
+BACKFILL_RATE = 2
+
 # What to display when we can't fit a quote?
 SNIP_TEXT = "*[...]*"
 # What to display when we cut off some text?
 TRUNCATE_TEXT = "..."
 # Minimum length of a quote before we 'snip for length'?
 MIN_QUOTE_LENGTH = 5
+# Inline formatting we render, in the order it gets applied (see _MarkdownRenderer)
+INLINE_FORMATS = ("spoiler", "poll", "strong", "em", "del")
+INLINE_FORMAT_MARKUP = {"strong": "**", "em": "*", "del": "~~"}
+
+# The only part of a profile page we care about (see _get_username)
+PROFILE_STRAINER = ("a", {"class": "member"})
+# The parts of a post that make it into the embed (see _parse_forum_post). The rest of the post,
+# like the signature, is never built into the tree.
+POST_STRAINER = ("div", {"class": ["post-header", "post-footer", "message-content"]})
+# Finds the link in a post's permalink without parsing it at all, so posts on excluded boards can
+# be dropped before we spend anything on them (see _peek_permalink)
+PERMALINK_PATTERN = re.compile(
+    r"""class=["'][^"']*\bpermalink\b[^>]*>\s*<a\b[^>]*?\bhref=["']([^"']*)["']""", re.IGNORECASE
+)
+
+# Everything Config covers, with its default, and the environment variable that can override it
+CONFIG_SETTINGS = {
+    "webhook_url_general": (None, "FORUM_SPY_DISCORD_WEBHOOK_URL"),
+    "webhook_url_mafia": (None, "FORUM_SPY_DISCORD_WEBHOOK_URL_MAFIA"),
+    "excluded_boards": (EXCLUDED_BOARDS, "FORUM_SPY_EXCLUDED_BOARDS"),
+    "mafia_boards": (MAFIA_BOARDS, "FORUM_SPY_MAFIA_BOARDS"),
+    "destinations": (DESTINATIONS, "FORUM_SPY_DESTINATIONS"),
+    "poll_interval_min": (POLL_INTERVAL_MIN, "FORUM_SPY_POLL_INTERVAL_MIN"),
+    "poll_interval_max": (POLL_INTERVAL_MAX, "FORUM_SPY_POLL_INTERVAL_MAX"),
+    "preview_length": (FORUM_PREVIEW_LENGTH, "FORUM_SPY_PREVIEW_LENGTH"),
+    "html_parser": (HTML_PARSER, "FORUM_SPY_HTML_PARSER"),
+    "forum_pool_size": (FORUM_POOL_SIZE, "FORUM_SPY_POOL_SIZE"),
+    "forum_pool_idle_timeout": (FORUM_POOL_IDLE_TIMEOUT, "FORUM_SPY_POOL_IDLE_TIMEOUT"),
+    "discord_pool_size": (DISCORD_POOL_SIZE, "FORUM_SPY_DISCORD_POOL_SIZE"),
+    "parse_workers": (PARSE_WORKERS, "FORUM_SPY_PARSE_WORKERS"),
+    "state_file": (STATE_FILE, "FORUM_SPY_STATE_FILE"),
+    "outbox_file": (OUTBOX_FILE, "FORUM_SPY_OUTBOX_FILE"),
+    "username_cache_file": (USERNAME_CACHE_FILE, "FORUM_SPY_USERNAME_CACHE_FILE"),
+}
+# Settings that count something, so they have to be whole numbers, and the least each can be
+CONFIG_COUNTS = {
+    "preview_length": 1,
+    "forum_pool_size": 1,
+    "discord_pool_size": 1,
+    "parse_workers": 0,
+}
+# What a destination can have (see _destinations)
+DESTINATION_SETTINGS = {"webhook_url": None, "boards": [], "excluded_boards": []}
+# Python 3.11 can read TOML config files by itself, older versions need the tomli module
+TOML_MODULE = "tomllib" if sys.version_info >= (3, 11) else "tomli"
 
 
 # # # # #
@@ -68,180 +205,672 @@ MIN_QUOTE_LENGTH = 5
 # # # # #
 
 
-def _get_username(user_profile):
+class Config:
+    """
+    The settings that can be tuned per deployment (see CONFIG_SETTINGS). Anything not given keeps
+    its default. The main loop, the parser and delivery take their settings from the Config
+    they're handed, so they can be used (or benchmarked) on their own.
+    """
+
+    def __init__(self, **settings):
+        unknown = sorted(set(settings) - set(CONFIG_SETTINGS))
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+        for name, (default, _) in CONFIG_SETTINGS.items():
+            value = settings.get(name, default)
+            _check_setting(name, value, default)
+            setattr(self, name, value)
+
+        for name, minimum in CONFIG_COUNTS.items():
+            value = getattr(self, name)
+            if not isinstance(value, int) or value < minimum:
+                raise ValueError(f"{name} must be a whole number, at least {minimum} (not {value})")
+        if not 0 < self.poll_interval_min <= self.poll_interval_max:
+            raise ValueError("poll_interval_min must be more than 0, and at most poll_interval_max")
+        if self.forum_pool_idle_timeout < 0:
+            raise ValueError("forum_pool_idle_timeout can't be negative")
+        for destination_name, destination in self.destinations.items():
+            unknown = sorted(set(destination) - set(DESTINATION_SETTINGS))
+            if unknown:
+                raise ValueError(f"Unknown destination settings: {', '.join(unknown)}")
+            for name, default in DESTINATION_SETTINGS.items():
+                value = destination.get(name, default)
+                _check_setting(f"destinations.{destination_name}.{name}", value, default)
+
+    @classmethod
+    def load(cls, path=None, environ=None):
+        """
+        Reads the settings from a TOML file (if a path is given) and then from the environment,
+        which takes precedence. Raises a ValueError if a setting doesn't make sense.
+        """
+        environ = os.environ if environ is None else environ
+        settings = {}
+        if path:
+            if importlib.util.find_spec(TOML_MODULE) is None:
+                raise ValueError(f"Reading {path} needs {TOML_MODULE} (is it installed?)")
+            with open(path, "rb") as config_file:
+                settings.update(importlib.import_module(TOML_MODULE).load(config_file))
+        for name, (default, env_var) in CONFIG_SETTINGS.items():
+            value = environ.get(env_var)
+            if value:
+                settings[name] = _parse_setting(value, default)
+        return cls(**settings)
+
+
+def _check_setting(name, value, default):
+    """
+    Raises a ValueError unless a setting is the same kind of thing as its default: a list of
+    strings, a table of tables, a finite number, or a string (or nothing, if that's the default).
+    """
+    if isinstance(default, list):
+        valid = isinstance(value, list) and all(isinstance(item, str) for item in value)
+        kind = "a list of strings"
+    elif isinstance(default, dict):
+        valid = isinstance(value, dict) and all(isinstance(item, dict) for item in value.values())
+        kind = "a table of tables"
+    elif isinstance(default, (int, float)):
+        valid = (
+            isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+        )
+        kind = "a finite number"
+    else:
+        valid = isinstance(value, str) or (default is None and value is None)
+        kind = "a string"
+    if not valid:
+        raise ValueError(f"{name} must be {kind}, not {value!r}")
+
+
+def _parse_setting(value, default):
+    """
+    Converts the value of an environment variable to the same kind of thing as the setting's
+    default. Lists are comma-separated, and tables are JSON objects.
+    """
+    if isinstance(default, dict):
+        return json.loads(value)
+    if isinstance(default, list):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    if isinstance(default, (int, float)):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    return value
+
+
+def _make_soup(markup, html_parser, parse_only=None):
+    """
+    Parses some forum HTML with the given parser backend. If parse_only is given (the name and
+    attrs of a SoupStrainer), only the matching elements are built into the tree.
+    """
+    strainer = None
+    # html5lib always builds the whole tree (and warns if we ask it not to)
+    if parse_only is not None and html_parser != "html5lib":
+        strainer = bs4.SoupStrainer(*parse_only)
+    return bs4.BeautifulSoup(markup, html_parser, parse_only=strainer)
+
+
+class DiscordWebhookError(Exception):
+    """
+    Discord didn't accept a webhook request.
+    """
+
+    def __init__(self, status, text, code=None):
+        super().__init__(f"{status}: {text} (Discord code {code})")
+        self.status = status
+        self.text = text
+        self.code = code
+
+
+class DiscordWebhook:
+    """
+    A Discord webhook we send embeds to. Keeps track of the webhook's rate limit from the
+    X-RateLimit headers Discord sends back, and holds off on the next request only when that would
+    go over it: while there are requests left in the bucket, they go out right away.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.remaining = None  # requests left in the bucket, or None if we don't know yet
+        self.reset_at = 0  # time.monotonic() at which the bucket fills back up
+
+    def __str__(self):
+        # (leaves out the token)
+        return f"webhook {self.url.rstrip('/').split('/')[-2]}"
+
+    def delay(self):
+        """
+        How long to wait before the next request is allowed to go out.
+        """
+        if self.remaining is None or self.remaining > 0:
+            return 0
+        return max(0, self.reset_at - time.monotonic())
+
+    async def send(self, session, payload):
+        """
+        Executes the webhook with a JSON payload (see _post_in_discord) once the rate limit allows
+        it, using a session from _discord_session. Returns the response headers, which include the
+        rate limit ones. Raises a DiscordWebhookError if Discord doesn't accept the request.
+        """
+        await asyncio.sleep(self.delay())
+        if self.remaining:
+            self.remaining -= 1
+        async with session.post(self.url, json=payload) as response:
+            self._update(response.status, response.headers)
+            if response.status >= 300:
+                text = await response.text()
+                try:
+                    error = json.loads(text)
+                    message, code = error["message"], error.get("code")
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    message, code = text, None
+                raise DiscordWebhookError(response.status, message, code)
+            return response.headers
+
+    def _update(self, status, headers):
+        now = time.monotonic()
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = now + float(reset_after)
+        if status == 429:
+            # We're being rate limited (maybe globally, which the bucket headers don't cover), so
+            # wait for as long as we're told to
+            self.remaining = 0
+            retry_after = headers.get("Retry-After")
+            if retry_after is not None:
+                self.reset_at = max(self.reset_at, now + float(retry_after))
+
+
+def _destinations(config):
+    """
+    Where posts can go, by name. Each destination has a webhook_url, and may list the boards it
+    wants posts from (otherwise it gets posts from everywhere) and excluded_boards it doesn't want
+    posts from after all. Without any configured, mafia posts go to the mafia webhook and
+    everything else to the general one.
+    """
+    if config.destinations:
+        return config.destinations
+    return {
+        "general": {
+            "webhook_url": config.webhook_url_general,
+            "excluded_boards": config.mafia_boards,
+        },
+        "mafia": {"webhook_url": config.webhook_url_mafia, "boards": config.mafia_boards},
+    }
+
+
+def _make_webhooks(config):
+    """
+    The webhook of each destination (see _destinations). Each destination gets a delivery
+    worker of its own (see _delivery_worker).
+    """
+    return {
+        name: DiscordWebhook(destination["webhook_url"])
+        for name, destination in _destinations(config).items()
+    }
+
+
+def _forum_session(config):
+    """
+    Creates the HTTP session used for all forum requests, backed by a keep-alive connection pool.
+    Must be called from within the event loop.
+    """
+    connector = aiohttp.TCPConnector(
+        limit_per_host=config.forum_pool_size, keepalive_timeout=config.forum_pool_idle_timeout
+    )
+    return aiohttp.ClientSession(
+        connector=connector, headers=FORUM_SPY_REQUEST_HEADERS, raise_for_status=True
+    )
+
+
+def _discord_session(config):
+    """
+    Creates the HTTP session used for all Discord webhook requests, backed by a keep-alive
+    connection pool of its own. Must be called from within the event loop. Every destination's
+    webhook is on the same host, so the pool has at least a connection per destination, or a slow
+    webhook could keep the others waiting for one.
+    """
+    pool_size = max(config.discord_pool_size, len(_destinations(config)))
+    connector = aiohttp.TCPConnector(
+        limit_per_host=pool_size, keepalive_timeout=DISCORD_POOL_IDLE_TIMEOUT
+    )
+    return aiohttp.ClientSession(
+        connector=connector, headers={"User-Agent": FORUM_SPY_REQUEST_HEADERS["User-Agent"]}
+    )
+
+
+def _write_json_atomically(path, data):
+    """
+    Writes JSON data to a file. The new file is written alongside the old one and then swapped in,
+    so a crash never leaves a half-written file behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as temp:
+        json.dump(data, temp)
+        temp.flush()
+        os.fsync(temp.fileno())
+    os.replace(temp.name, path)
+
+
+class UsernameCache:
+    """
+    Remembers user names by profile URL. Entries expire after their TTL, and the least recently
+    used ones are dropped once there are more than max_size. If a path is given, the cache is
+    loaded from there and save() writes it back.
+    """
+
+    def __init__(self, path=USERNAME_CACHE_FILE, max_size=USERNAME_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # profile URL -> (user name, expiry time)
+        self.dirty = False
+        if not path:
+            return
+        try:
+            with open(path, "r") as cache:
+                for user_profile, user_name, expires in json.load(cache):
+                    if expires > time.time():
+                        self.entries[user_profile] = (user_name, expires)
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as err:
+            print(f"Ignoring unreadable username cache {path} ({str(err)})")
+
+    def get(self, user_profile):
+        """
+        Returns the cached name for a profile, or None if there isn't one (or it expired).
+        """
+        entry = self.entries.get(user_profile)
+        if entry is None:
+            return None
+        user_name, expires = entry
+        if expires <= time.time():
+            del self.entries[user_profile]
+            self.dirty = True
+            return None
+        self.entries.move_to_end(user_profile)
+        return user_name
+
+    def put(self, user_profile, user_name, ttl):
+        """
+        Caches the name for a profile for ttl seconds.
+        """
+        self.entries[user_profile] = (user_name, time.time() + ttl)
+        self.entries.move_to_end(user_profile)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def save(self):
+        """
+        Writes the cache back to its file, if it has one and anything changed.
+        """
+        if not self.path or not self.dirty:
+            return
+        self.dirty = False
+        entries = [[user_profile, *entry] for user_profile, entry in list(self.entries.items())]
+        _write_json_atomically(self.path, entries)
+
+
+def _username_fallback(user_profile, cache=None):
+    """
+    The name to show when we can't get one from the profile: the end of the profile URL. It goes
+    into the cache for a shorter time than real names do.
+    """
+    user_name = user_profile.split("/")[-1]
+    if cache is not None:
+        cache.put(user_profile, user_name, USERNAME_CACHE_ERROR_TTL)
+    return user_name
+
+
+async def _get_username(session, user_profile, html_parser, cache=None):
     """
     Requests the user profile and parses the name out of it (used for members with avatars).
-    If the request fails, just default to the URL string.
+    If the request fails (or the name isn't where we expect it), just default to the URL string.
+    If a UsernameCache is given, it's checked first and the result (even a failure) goes into it.
     """
+    if cache is not None:
+        user_name = cache.get(user_profile)
+        if user_name is not None:
+            return user_name
+
     try:
-        profile_request = urllib.request.Request(user_profile, headers=FORUM_SPY_REQUEST_HEADERS)
-        with urllib.request.urlopen(profile_request) as response:
-            data = response.read()
-    except urllib.error.HTTPError as err:
-        print(f"While querying {user_profile}, {err.code}: {err.reason}")
-        return user_profile.split("/")[-1]
+        async with session.get(user_profile) as response:
+            data = await response.read()
+    except aiohttp.ClientResponseError as err:
+        print(f"While querying {user_profile}, {err.status}: {err.message}")
+        return _username_fallback(user_profile, cache)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        # e.g. the server dropped a pooled connection, or took too long
+        print(f"While querying {user_profile}, encountered {str(err)}")
+        return _username_fallback(user_profile, cache)
+
+    # The page is big, but we only need the one link out of it. It's near the top of the page, so
+    # if we can spot where it ends, don't even look at the rest. (If what we spotted turns out not
+    # to be the link, look at the whole page after all.)
+    member = None
+    member_start = data.find(b'class="member"')
+    member_end = data.find(b"</a>", member_start) if member_start != -1 else -1
+    if member_end != -1:
+        head = data[: member_end + len(b"</a>")]
+        soup = _make_soup(head, html_parser, parse_only=PROFILE_STRAINER)
+        member = soup.find("a", {"class": "member"})
+    if member is None:
+        soup = _make_soup(data, html_parser, parse_only=PROFILE_STRAINER)
+        member = soup.find("a", {"class": "member"})
+    if member is None or member.string is None:
+        print(f"Couldn't find the member name in {user_profile}")
+        return _username_fallback(user_profile, cache)
+    # (a plain str, so we don't hang on to the whole soup)
+    user_name = str(member.string)
+    if cache is not None:
+        cache.put(user_profile, user_name, USERNAME_CACHE_TTL)
+    return user_name
+
 
-    soup = BeautifulSoup(data, "html.parser")
-    member = soup.find("a", {"class": "member"})
-    return member.string
+def _block_spoiler_title(node):
+    """
+    If node is a block spoiler that gets replaced by its title, returns the replacement text.
+    """
+    if node.name != "div" or "spoiler_container" not in node.get("class", ()):
+        return None
+    button = node.find("button", {"class": "spoileron"})
+    if button is None:
+        return None
+    return f"**[{button.get_text()}]**\n"
 
 
-def _format_quotes_and_spoilers(content, max_length, nesting):
+def _annotate_text_lengths(node, text_lengths):
     """
-    Handle blockquotes and spoiler blocks. Recursively formats inner quote content the same way.
+    Measures how much text node holds, and the same for every tag under it, in one bottom-up pass.
+    (Measuring each quote separately would walk nested quotes over and over again.)
+
+    Each tag's id maps to three lengths in text_lengths:
+    - how much non-quote, non-spoiler text it holds at the top level of a post,
+    - the same inside a quote, where block spoilers have been replaced with their titles by the
+      time the quote gets formatted (so the titles count as text),
+    - how much text truncation gets to cut: everything but quotes, newlines included.
+    """
+    top_length = quote_length = cut_length = 0
+    for child in node.childGenerator():
+        if child.name:
+            child_lengths = _annotate_text_lengths(child, text_lengths)
+        # Skip children that are blockquotes
+        if child.name and child.name == "blockquote":
+            continue
+        spoiler_title = _block_spoiler_title(child) if child.name else None
+        # Count length of string nodes
+        if child.string:
+            if child.string != "\n":
+                top_length += len(child.string)
+                quote_length += len(child.string) if spoiler_title is None else 0
+            cut_length += len(child.string) if spoiler_title is None else 0
+        # Skip children that are block spoilers
+        elif child.has_attr("class") and "spoiler_container" in child["class"]:
+            pass
+        # Add non-string children's length
+        else:
+            top_length += child_lengths[0]
+            quote_length += child_lengths[1]
+            cut_length += child_lengths[2]
+        if spoiler_title is not None:
+            quote_length += len(spoiler_title)
+            cut_length += len(spoiler_title)
+    text_lengths[id(node)] = (top_length, quote_length, cut_length)
+    return top_length, quote_length, cut_length
+
+
+class _MarkdownRenderer:
+    """
+    Renders the content of a forum post (or of a quote in it) as Discord markdown, in a single walk
+    over the tree that doesn't modify it.
 
     We want to only show quotes if we have enough room after truncation (i.e. we don't want to have
     the preview be just quotes.) So we see how much space should be devoted to non-quote text and
     then divide up remaining space among quotes which will get shortened. (unless the remaining
     size per quote is very short or zero in which case we'll just replace the quote with '[...]')
+    Quotes are rendered by a renderer of their own, as plain text.
+
+    Truncation works out up front where the cut goes, then counts text during the walk: everything
+    before the cut is rendered as usual, the text that straddles it gets cut short, and the walk
+    stops right after it, so nothing past the cut gets rendered. Working out where the cut goes
+    still takes counting all of the post's text (see _annotate_text_lengths), and every quote
+    directly in the content is rendered up front (quotes count towards the cut in full), so a
+    wall of text still costs more than a short post, just less than it used to.
+
+    Inline formatting is applied the way the forum markup nests, but formatting inside formatting
+    that comes earlier in INLINE_FORMATS (e.g. bold inside a spoiler) is rendered as plain text.
     """
-    # Determine how much non-quote text is here
-    def rec_textlength(node):
-        text_length = 0
+
+    def __init__(self, text_lengths, string_types, nesting=0, formats=INLINE_FORMATS):
+        self.text_lengths = text_lengths
+        # Strings that get_text() would include (e.g. not comments)
+        self.string_types = string_types
+        self.nesting = nesting
+        self.formats = formats
+        self.quotes = {}  # id(quote) -> markdown, for quotes directly in the content
+        self.cut_at = None  # how much text fits before the cut, or None if it all fits
+        self.position = 0  # how much text we've walked past so far
+        self.cut_done = False
+        self.poll_done = False  # only the first poll gets rendered as a poll
+        self.overrides = {}  # id(string) -> what to render in its place
+        self.blanked = set()  # ids of nodes that are walked but not rendered (spoiler titles)
+        self.captured = {}  # id(node) -> its rendered text (poll titles and options)
+
+    def render(self, content, max_length):
+        """
+        Renders content, cut down to about max_length characters of non-quote text.
+        """
+        lengths = self.text_lengths[id(content)]
+        text_length = lengths[0 if self.nesting == 0 else 1]
+
+        # If we have any blockquotes, we want to format/truncate them recursively
+        blockquotes = content.find_all("blockquote", recursive=False)
+        if blockquotes:
+            # Find how much space can be devoted to each quote -- divide any remaining
+            # space among them evenly
+            remaining_length = (max_length - text_length) // len(blockquotes)
+            for quote in blockquotes:
+                self.quotes[id(quote)] = self._render_quote(quote, remaining_length)
+
+        if text_length > max_length:
+            # Quotes count as text (in full) when truncating, though not when budgeting
+            cut_length = lengths[2] + sum(len(quote) for quote in self.quotes.values())
+            self.cut_at = cut_length - (text_length - max_length)
+
+        return self._render_children(content, self.formats, counted=True)
+
+    def _render_quote(self, quote, max_length):
+        quote_by = _find_cite(quote)
+        quote_content = quote.find("div", {"class": "quotey"})
+        if max_length > MIN_QUOTE_LENGTH:
+            # Recursively render inner quote text
+            # (base case is no quotes in which case the renderer doesn't make any more of these)
+            renderer = _MarkdownRenderer(
+                self.text_lengths, self.string_types, self.nesting + 1, formats=()
+            )
+            quote_text = renderer.render(quote_content, max_length)
+            markdown_quote = "\n".join(("> " + line) for line in quote_text.split("\n"))
+        else:
+            markdown_quote = f"> {SNIP_TEXT}"
+
+        # if quote has a cite, add it
+        if quote_by is not None:
+            quote_by_text = self._render_children(quote_by, (), counted=False)
+            markdown_quote = f"> **{quote_by_text}**\n" + markdown_quote
+
+        # If multiple quotes next to each other, add a separating line
+        # (block spoilers in between don't count, they're just their title by now)
+        next_elem = quote.find_next_sibling()
+        while next_elem is not None and _block_spoiler_title(next_elem) is not None:
+            next_elem = next_elem.find_next_sibling()
+        if self.nesting > 0 or next_elem and next_elem.name and next_elem.name == "blockquote":
+            # we also add a separating line if nesting > 0 i.e. we're inside a nested quote,
+            # because discord doesn't actually support nested quotes so it can be hard to
+            # tell where a line ending with ">" ends and we aren't in the quote anymore
+            markdown_quote += "\n"
+
+        return markdown_quote
+
+    def _cut(self, text, kept_text=None):
+        """
+        Walks past some text that counts towards truncation. Returns what to render for it:
+        kept_text (or the text itself) if it's before the cut, nothing if it's past the cut, and
+        whatever's left of it if it straddles the cut.
+        """
+        start = self.position
+        self.position += len(text)
+        if self.cut_at is None or self.position <= self.cut_at:
+            return text if kept_text is None else kept_text
+        if start > self.cut_at:
+            return ""
+        self.cut_done = True
+        return text[: self.cut_at - start] + TRUNCATE_TEXT
+
+    def _render_children(self, node, formats, counted):
+        rendered = []
         for child in node.childGenerator():
-            # Skip children that are blockquotes
-            if child.name and child.name == "blockquote":
-                continue
-            # Count length of string nodes
-            if child.string:
-                if child.string != "\n":
-                    text_length += len(child.string)
-            # Skip children that are block spoilers
-            elif child.has_attr("class") and "spoiler_container" in child["class"]:
-                continue
-            # Add non-string children's length recursively
-            elif child is not node:
-                text_length += rec_textlength(child)
-        return text_length
-
-    text_length = rec_textlength(content)
-
-    # Block spoilers replaced with title
-    block_spoilers = content.find_all("div", {"class": "spoiler_container"})
-    for spoiler in block_spoilers:
-        if spoiler.find("button", {"class": "spoileron"}):
-            # if it wasn't stripped out during the truncation process...
-            spoilertitle = spoiler.find("button", {"class": "spoileron"}).get_text()
-            spoiler.replace_with(f"**[{spoilertitle}]**\n")
-
-    # If we have any blockquotes, we want to format/truncate them recursively
-    blockquotes = content.find_all("blockquote", recursive=False)
-
-    if blockquotes:
-        # Find how much space can be devoted to each quote -- divide any remaining
-        # space among them evenly
-        remaining_length = (max_length - text_length) // len(blockquotes)
-        for quote in blockquotes:
-            quote_by = quote.find("div", {"class": "citey"})
-            quote_content = quote.find("div", {"class": "quotey"})
-            if remaining_length > MIN_QUOTE_LENGTH:
-                # Recursively format inner quote text
-                # (base case is no quotes in which case this loop doesn't run)
-                _format_quotes_and_spoilers(quote_content, remaining_length, nesting + 1)
-                markdown_quote = "\n".join(
-                    ("> " + line) for line in quote_content.get_text().split("\n")
-                )
-            else:
-                markdown_quote = f"> {SNIP_TEXT}"
-
-            # if quote has a cite, add it
-            if quote_by is not None:
-                markdown_quote = f"> **{quote_by.get_text()}**\n" + markdown_quote
-
-            # If multiple quotes next to each other, add a separating line
-            next_elem = quote.find_next_sibling()
-            if nesting > 0 or next_elem and next_elem.name and next_elem.name == "blockquote":
-                # we also add a separating line if nesting > 0 i.e. we're inside a nested quote,
-                # because discord doesn't actually support nested quotes so it can be hard to
-                # tell where a line ending with ">" ends and we aren't in the quote anymore
-                markdown_quote += "\n"
-
-            quote.replace_with(markdown_quote)
-
-    def rec_truncate(node, deficit):
-        """
-        Recursive function to truncate *non-quoted* text.
-
-        'deficit' is how much we have to cut off. But we want to avoid slicing quotes in half
-        when truncating, so we want to remove them wholesale if we run into them rather than
-        just cutting the result of get_text() at the very end. Hence the semi-convoluted logic.
-        """
-        # We iterate over the children of the node in reverse so we start cutting from the end
-        for child in reversed(list(node.childGenerator())):
-            if child.name and child.name == "blockquote":
-                # Since we still have a deficit (i.e. we're still looping, so we still want to be
-                # cutting stuff off from the end), just remove the quote wholesale since it's going
-                # to be after the '...' in the post
-                child.clear()
-            elif child.string:
-                if len(child.string) < deficit:
-                    # Remove the whole child and reduce the deficit by its length.
-                    deficit -= len(child.string)
-                    child.string.replace_with("")
-                else:
-                    # We reduced the deficit enough! Should fit under the character limit now.
-                    child.string.replace_with(child.string[:-deficit] + TRUNCATE_TEXT)
-                    deficit = 0
-                    break
-            elif child.has_attr("class") and "spoiler_container" in child["class"]:
-                # Strip block spoilers for same reason as blockquotes
-                child.clear()
-            else:
-                # It's some kind of weird compound tag
-                deficit = rec_truncate(child, deficit)
-                if deficit <= 0:
-                    break
+            if counted and self.cut_done:
+                # Everything from here on is past the cut
+                break
+            rendered.append(self._render_node(child, formats, counted))
+        return "".join(rendered)
+
+    def _render_node(self, node, formats, counted):
+        """
+        Renders a node. 'counted' nodes count towards truncation; the others (e.g. inside a quote
+        that's kept whole) are rendered in full.
+        """
+        if counted:
+            text = self._render_counted(node, formats)
+        else:
+            text = self._render_uncounted(node, formats)
+        if id(node) in self.captured:
+            self.captured[id(node)] = text
+        if id(node) in self.blanked:
+            return ""
+        return text
+
+    def _render_counted(self, node, formats):
+        if not node.name:
+            return self._cut(node, node if type(node) in self.string_types else "")
+        if id(node) in self.quotes:
+            # Quotes directly in the content are cut like any other text
+            return self._cut(self.quotes[id(node)])
+        spoiler_title = _block_spoiler_title(node)
+        if node.name == "blockquote" or (
+            spoiler_title is None
+            and not node.string
+            and "spoiler_container" in node.get("class", ())
+        ):
+            # Other quotes and block spoilers don't count, but we don't want to slice them in half
+            # either. (Past the cut, the walk never gets to them at all.) The old renderer did count
+            # a block spoiler's title in such a quote if it was the only thing in the tags around
+            # it, so it cut those posts a few characters later.
+            return self._render_uncounted(node, formats)
+        if spoiler_title is not None:
+            return self._cut(spoiler_title)
+        if node.string:
+            # A tag around just one string counts as that string
+            string = node.string
+            self.overrides[id(string)] = self._cut(
+                string, string if type(string) in self.string_types else ""
+            )
+            return self._render_uncounted(node, formats)
+        # It's some kind of compound tag
+        return self._render_tag(node, formats, counted=True)
+
+    def _render_uncounted(self, node, formats):
+        if not node.name:
+            if id(node) in self.overrides:
+                return self.overrides[id(node)]
+            return node if type(node) in self.string_types else ""
+        spoiler_title = _block_spoiler_title(node)
+        if spoiler_title is not None:
+            return spoiler_title
+        return self._render_tag(node, formats, counted=False)
 
-        return deficit
+    def _render_tag(self, tag, formats, counted):
+        classes = tag.get("class", ())
 
-    if text_length > max_length:
-        rec_truncate(content, text_length - max_length)
+        # Spoilerize inline spoilers
+        if tag.name == "span" and "inline_spoiler" in classes and "spoiler" in formats:
+            # Drop the red spoiler title if there is one
+            if tag.span:
+                self.blanked.add(id(tag.span))
+            return f"||{self._render_children(tag, (), counted)}||"
 
+        # Render polls (only one possible per post)
+        if tag.name == "div" and "poll" in classes and "poll" in formats and not self.poll_done:
+            self.poll_done = True
+            return self._render_poll(tag, formats, counted)
 
-def _convert_formatting(content):
-    _format_quotes_and_spoilers(content, FORUM_PREVIEW_LENGTH, 0)
+        # Basic formatting
+        markup = INLINE_FORMAT_MARKUP.get(tag.name)
+        if markup and tag.name in formats:
+            text = self._render_children(tag, _formats_before(tag.name, formats), counted)
+            return f"{markup}{text}{markup}" if text else text
 
-    # Spoilerize inline spoilers
-    inline_spoilers = content.find_all("span", {"class": "inline_spoiler"})
-    for spoiler in inline_spoilers:
-        # Drop the red spoiler title if there is one
-        if spoiler.span:
-            spoiler.span.clear()
-        new_spoiler = f"||{spoiler.get_text()}||"
-        spoiler.replace_with(new_spoiler)
+        return self._render_children(tag, formats, counted)
 
-    # Render polls (only one possible per post)
-    poll = content.find("div", {"class": "poll"})
-    if poll:
-        poll_title = poll.find("div", {"class": "poll-header"}).h3.get_text()
+    def _render_poll(self, poll, formats, counted):
+        poll_title = poll.find("div", {"class": "poll-header"}).h3
         # no point rendering the vote count, as we'll usually just see zero
-        option_lis = poll.find("form", {"class": "poll-body"}).ol.find_all("li")
-        options = [""] + [li.label.get_text() for li in option_lis]
-        poll.replace_with(f"**{poll_title}**" + "\n> □ ".join(options) + "\n")
+        option_labels = [li.label for li in poll.find("form", {"class": "poll-body"}).ol("li")]
+        for node in [poll_title] + option_labels:
+            self.captured[id(node)] = ""
+        # The rest of the poll still has to be walked, as it counts towards truncation
+        self._render_children(poll, _formats_before("poll", formats), counted)
+        options = [""] + [self.captured[id(label)] for label in option_labels]
+        return f"**{self.captured[id(poll_title)]}**" + "\n> □ ".join(options) + "\n"
 
-    # Basic formatting
-    bolds = content.find_all("strong")
-    for bold in bolds:
-        if bold.get_text():
-            bold.replace_with(f"**{bold.get_text()}**")
 
-    italics = content.find_all("em")
-    for italic in italics:
-        if italic.get_text():
-            italic.replace_with(f"*{italic.get_text()}*")
+def _find_cite(node):
+    """
+    Finds the first cite in node, not counting ones in block spoilers (which are just their title
+    by the time a quote gets rendered.)
+    """
+    for child in node.children:
+        if not child.name or _block_spoiler_title(child) is not None:
+            continue
+        if child.name == "div" and "citey" in child.get("class", ()):
+            return child
+        cite = _find_cite(child)
+        if cite is not None:
+            return cite
+    return None
 
-    strikethroughs = content.find_all("del")
-    for strikethrough in strikethroughs:
-        if strikethrough.get_text():
-            strikethrough.replace_with(f"~~{strikethrough.get_text()}~~")
 
+def _formats_before(name, formats):
+    """
+    The formats that still apply inside a 'name' format (the ones that come before it).
+    """
+    return tuple(f for f in formats if INLINE_FORMATS.index(f) < INLINE_FORMATS.index(name))
 
-def _parse_forum_post(data):  # pylint:disable=too-many-locals
+
+def _render_markdown(content, max_length=FORUM_PREVIEW_LENGTH):
+    """
+    Renders the message content of a post as Discord markdown, cut down to about max_length
+    characters (quotes aside).
+    """
+    text_lengths = {}
+    _annotate_text_lengths(content, text_lengths)
+    string_types = content.interesting_string_types or bs4.Tag.MAIN_CONTENT_STRING_TYPES
+    if isinstance(string_types, type):
+        string_types = (string_types,)
+    return _MarkdownRenderer(text_lengths, string_types).render(content, max_length)
+
+
+def _parse_forum_post(data, config):  # pylint:disable=too-many-locals
     """
     Pulls apart the AJAX data to find the bits of the forum post we want to display in
-    the Discord embed.
+    the Discord embed. Members with avatars have no name in the post header; for those, the
+    user name is left as None and filled in afterwards by _resolve_username.
     """
-    soup = BeautifulSoup(data[1], "html.parser")  # format is [postID, html]
+    # format is [postID, html]
+    soup = _make_soup(data[1], config.html_parser, parse_only=POST_STRAINER)
     post_id = data[0]
 
     # Header: sprite, username, badges
@@ -252,10 +881,8 @@ def _parse_forum_post(data):  # pylint:disable=too-many-locals
         user_sprite = None
     member = header.h3.a
     user_profile = FORUM_ROOT + member["href"]
-    if member.string:
-        user_name = member.string
-    else:
-        user_name = _get_username(user_profile)
+    # (a plain str, so the post can be pickled without dragging the whole soup along)
+    user_name = str(member.string) if member.string else None
 
     # Footer: date, thumb score, utils (quote, report, permalink)
     footer = soup.find("div", {"class": "post-footer"})
@@ -264,14 +891,11 @@ def _parse_forum_post(data):  # pylint:disable=too-many-locals
     permalink = utils.find("li", {"class": "permalink"})
     url = FORUM_ROOT + permalink.a["href"]
 
-    # Body: message content, signature
-    body = soup.find("div", {"class": "post-body"})
-    content = body.find("div", {"class": "message-content"})
-
-    _convert_formatting(content)
+    # Body: message content (the signature was left out while parsing)
+    content = soup.find("div", {"class": "message-content"})
 
-    # Convert to plaintext and strip extra whitespace.
-    text = content.get_text().strip()
+    # Convert to markdown and strip extra whitespace.
+    text = _render_markdown(content, config.preview_length).strip()
 
     # We may have just stripped away part of an inline spoiler, so fix that if needed
     # (should be an even number of '||' delimiters)
@@ -293,27 +917,181 @@ def _parse_forum_post(data):  # pylint:disable=too-many-locals
     return post
 
 
-def _post_in_discord(post):
+def _peek_permalink(data):
     """
-    Sends a webhook request to Discord, containing an embedded forum post.
-    If an error occurs, will retry up to a total of 5 attempts before giving up.
+    The permalink URL of a post, found in its AJAX data with a quick scan instead of a parse, or
+    None if it isn't where we expect it (then only parsing the post can tell where it goes).
     """
-    # See: https://discord.com/developers/docs/resources/channel#embed-object
+    match = PERMALINK_PATTERN.search(data[1])
+    if match is None:
+        return None
+    return FORUM_ROOT + html.unescape(match.group(1))
 
-    # Drop posts from excluded boards/subforums
-    if any([board in post["url"] for board in EXCLUDED_BOARDS]):
-        print(f"Not posting {post['url']} (excluded board)")
-        return
 
-    # Map mafia posts to the correct webhook
-    # If this mapping logic ever becomes more complicated we'll want some sort of dict lookup
-    webhook = (
-        DISCORD_WEBHOOK_MAFIA
-        if any([board in post["url"] for board in MAFIA_BOARDS])
-        else DISCORD_WEBHOOK_GENERAL
-    )
+def _post_ajax_from_page(page, post_id, html_parser):
+    """
+    Finds a post in a forum message page, and returns it in the same [postID, html] form as the
+    forum spy AJAX data (or None if it isn't there).
+    """
+    id_str = f"post{post_id}"
+    # (only the post itself is built into the tree, not the rest of the page)
+    soup = _make_soup(page, html_parser, parse_only=("div", {"id": id_str}))
+    post = soup.find("div", {"id": id_str})
+    if post is None:
+        return None
+    return [id_str, str(post)]
+
+
+async def _get_forum_post(session, post_id, html_parser):
+    """
+    Requests the message page for a post and returns its AJAX data, or None if it can't be had
+    (most likely it was deleted, or it's on a board we can't see).
+    """
+    message_url = f"{FORUM_ROOT}/forum/message/{post_id}"
+    try:
+        async with session.get(message_url) as response:
+            page = await response.read()
+    except aiohttp.ClientResponseError as err:
+        print(f"While querying {message_url}, {err.status}: {err.message}")
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        print(f"While querying {message_url}, encountered {str(err)}")
+        return None
+    # Parsing a whole page takes a while, so do it in a thread rather than hold up the event loop
+    return await asyncio.to_thread(_post_ajax_from_page, page, post_id, html_parser)
+
+
+class RateLimiter:
+    """
+    Spaces out requests so that no more than 'rate' of them start per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_start = 0
+
+    async def wait(self):
+        """
+        Waits until the next request is allowed to start.
+        """
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        await asyncio.sleep(start - now)
+
+
+async def _backfill_posts(session, first_post_id, end_post_id, html_parser):
+    """
+    Fetches the AJAX data for the posts from first_post_id up to (not including) end_post_id,
+    which we missed because they fell out of the spy window between polls. Returns them oldest to
+    newest, skipping any that don't exist or can't be seen.
+    """
+    post_ids = range(max(first_post_id, end_post_id - BACKFILL_LIMIT), end_post_id)
+    if post_ids.start > first_post_id:
+        missed = end_post_id - first_post_id
+        print(f"Missed {missed} post IDs, backfilling the last {len(post_ids)}")
+    else:
+        print(f"Missed {len(post_ids)} post IDs, backfilling")
+
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+    rate_limiter = RateLimiter(BACKFILL_RATE)
+
+    async def backfill(post_id):
+        async with semaphore:
+            await rate_limiter.wait()
+            return await _get_forum_post(session, post_id, html_parser)
+
+    posts = await asyncio.gather(*(backfill(post_id) for post_id in post_ids))
+    return [postdata for postdata in posts if postdata is not None]
+
+
+async def _resolve_username(session, post, config, cache=None):
+    """
+    Fills in the user name of a post from a member with an avatar, by looking up their profile.
+    """
+    if post["user_name"] is None:
+        post["user_name"] = await _get_username(
+            session, post["user_profile"], config.html_parser, cache
+        )
+    return post
+
+
+def _path_segments(url):
+    """
+    The segments of a URL's path, e.g. ["forum", "Community", "mafia", ...].
+    """
+    return urllib.parse.urlsplit(url).path.strip("/").split("/")
+
+
+class BoardRouter:
+    """
+    Works out where a post goes from the board it's on. The routes (board path -> where its posts
+    go) are built into a trie of path segments once, so routing a post costs a few dict lookups no
+    matter how many routes there are. The most specific board wins, and posts on boards without a
+    route go to the default.
+    """
+
+    def __init__(self, routes, default):
+        self.default = default
+        self.trie = {}  # path segment -> subtrie; the None key holds the route for the board
+        for board, destination in routes.items():
+            node = self.trie
+            for segment in _path_segments(board):
+                node = node.setdefault(segment, {})
+            node[None] = destination
+
+    def route(self, url):
+        """
+        Which destination a post goes to, going by its URL.
+        """
+        destination = self.default
+        node = self.trie
+        for segment in _path_segments(url):
+            node = node.get(segment)
+            if node is None:
+                break
+            if None in node:
+                destination = node[None]
+        return destination
+
+
+def _make_router(config):
+    """
+    Routes each post to the set of destinations that want it (see _destinations). For each
+    destination, the most specific of its boards and excluded boards that the post is on decides.
+    Posts from the excluded boards/subforums in config.excluded_boards go nowhere, unless a
+    destination subscribes to a board within one.
+    """
+    subscriptions = {}  # destination -> ({board path segments: wanted?}, wanted by default?)
+    for name, destination in _destinations(config).items():
+        boards = destination.get("boards", [])
+        excluded = config.excluded_boards + destination.get("excluded_boards", [])
+        rules = {tuple(_path_segments(board)): False for board in excluded}
+        rules.update({tuple(_path_segments(board)): True for board in boards})
+        subscriptions[name] = (rules, not boards)
+
+    def subscribers(segments):
+        found = set()
+        for name, (rules, wanted) in subscriptions.items():
+            for depth in range(len(segments) + 1):
+                wanted = rules.get(segments[:depth], wanted)
+            if wanted:
+                found.add(name)
+        return frozenset(found)
 
-    embed_data = {
+    # Every board any destination mentions gets a route, worked out for all destinations at once
+    boards = {board for rules, _ in subscriptions.values() for board in rules}
+    return BoardRouter({"/".join(board): subscribers(board) for board in boards}, subscribers(()))
+
+
+def _embed_data(post):
+    """
+    The embed for a forum post. Posts in the outbox already come with theirs (see _parse_worker).
+    """
+    if "embed" in post:
+        return post["embed"]
+    # See: https://discord.com/developers/docs/resources/channel#embed-object
+    return {
         # Alternate forum post colors
         "color": (FORUM_COLOR_EVEN if int(post["id"][-1]) % 2 == 0 else FORUM_COLOR_ODD),
         "author": {"name": post["user_name"], "url": post["user_profile"]},
@@ -321,18 +1099,69 @@ def _post_in_discord(post):
         "description": f"{post['text']}\n\n{post['url']}",
     }
 
-    print(f"Posting {post['id']} to {webhook}")
+
+def _embed_length(post):
+    """
+    How many characters a post's embed counts for, towards DISCORD_MAX_EMBED_CHARS.
+    """
+    embed_data = _embed_data(post)
+    return len(embed_data["author"]["name"] or "") + len(embed_data["description"])
+
+
+def _next_batch(posts):
+    """
+    How many of the posts (oldest first, all for the same webhook) can go out together in one
+    webhook message: the ones in front that fit (see DISCORD_MAX_EMBEDS).
+    """
+    batch_length = 0
+    for count, post in enumerate(posts[:DISCORD_MAX_EMBEDS]):
+        batch_length += _embed_length(post)
+        if count and batch_length > DISCORD_MAX_EMBED_CHARS:
+            return count
+    return min(len(posts), DISCORD_MAX_EMBEDS)
+
+
+async def _post_in_discord(session, webhook, posts):
+    """
+    Sends a webhook request to Discord, containing the embedded forum posts.
+    If an error occurs, will retry up to a total of 5 attempts. (Rate limited attempts are retried
+    as soon as the rate limit allows, see DiscordWebhook.)
+
+    Returns how many of the posts (from the front) we're done with: the rest didn't get through
+    but should be tried again later (e.g. Discord is down). Requests Discord rejects outright
+    aren't retried, but if one had several posts in it, they're sent one at a time instead, so
+    only the one that's actually bad gets left out.
+    """
+    post_ids = ", ".join(post["id"] for post in posts)
+    payload = {
+        "embeds": [_embed_data(post) for post in posts],
+        "allowed_mentions": DISCORD_NO_MENTIONS,
+    }
+
+    print(f"Posting {post_ids} to {webhook}")
     for _ in range(5):
         try:
-            webhook.send(
-                embed=discord.Embed.from_dict(embed_data),
-                allowed_mentions=DISCORD_NO_MENTIONS,
-            )
-            return
-        except discord.HTTPException as err:
-            print(f"{post['id']}, {err.status}: {err.text} (Discord code {err.code})")
-            time.sleep(5)
-    print(f"Failed to send {post['id']}")
+            await webhook.send(session, payload)
+            return len(posts)
+        except DiscordWebhookError as err:
+            print(f"{post_ids}, {str(err)}")
+            if 400 <= err.status < 500 and err.status != 429:
+                if len(posts) > 1:
+                    print(f"Sending {post_ids} one at a time instead")
+                    for count, post in enumerate(posts):
+                        if not await _post_in_discord(session, webhook, [post]):
+                            return count
+                    return len(posts)
+                # Sending the same thing again won't go any better
+                print(f"Failed to send {post_ids}")
+                return len(posts)
+            if err.status != 429:
+                await asyncio.sleep(DISCORD_RETRY_INTERVAL)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            print(f"{post_ids}, encountered {str(err)}")
+            await asyncio.sleep(DISCORD_RETRY_INTERVAL)
+    print(f"Couldn't send {post_ids} yet")
+    return 0
 
 
 # # # # #
@@ -340,53 +1169,438 @@ def _post_in_discord(post):
 # # # # #
 
 
-def forum_spy_loop():
+async def _get_forum_spy_data(session, validators):
+    """
+    Requests the forum spy AJAX data. Returns a list of [postID, html] pairs, oldest to newest,
+    or None if nothing has changed since the last request made with the same validators dict.
+
+    If the server hands out an ETag or Last-Modified date we make a conditional request and it
+    can answer with a bodyless 304. Otherwise we compare a hash of the raw body with the last
+    one, which still saves us decoding (and walking) an unchanged payload.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    async with session.get(FORUM_SPY_AJAX, headers=headers) as response:
+        if response.status == 304:
+            return None
+        body = await response.read()
+        validators["etag"] = response.headers.get("ETag")
+        validators["last_modified"] = response.headers.get("Last-Modified")
+
+    digest = hashlib.blake2b(body, digest_size=16).digest()
+    if digest == validators.get("digest"):
+        return None
+    data = json.loads(body)
+    # Only remember bodies that decoded, so a bad payload gets reported every time
+    validators["digest"] = digest
+    return data
+
+
+class PollScheduler:
+    """
+    Works out how long to wait before the next forum spy poll, based on what the last polls found.
+    """
+
+    def __init__(self, min_interval=POLL_INTERVAL_MIN, max_interval=POLL_INTERVAL_MAX):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = self._clamp(POLL_INTERVAL)
+        self.errors = 0
+
+    def _clamp(self, interval):
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def _jitter(self, interval):
+        return self._clamp(interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER))
+
+    def polled(self, new_posts, window_size):
+        """
+        Call after a successful poll that found new_posts new posts out of window_size returned.
+        Returns how long to wait before polling again.
+        """
+        self.errors = 0
+        if new_posts and new_posts >= window_size:
+            # Everything in the window was new, so we may already be missing posts. Hurry up!
+            self.interval = self.min_interval
+        elif new_posts:
+            self.interval = self._clamp(self.interval / 2)
+        else:
+            self.interval = self._clamp(self.interval * 1.5)
+        return self._jitter(self.interval)
+
+    def failed(self):
+        """
+        Call after a failed poll. Returns how long to wait before trying again.
+        """
+        self.errors = min(self.errors + 1, 10)
+        return self._jitter(POLL_ERROR_INTERVAL * 2 ** (self.errors - 1))
+
+
+class HighWaterMark:
+    """
+    The ID of the newest post we've finished with (put in the outbox, or given up on),
+    checkpointed to a small JSON state file.
+    """
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.post_id = 0
+        self.saved_post_id = 0
+        try:
+            with open(path, "r") as state:
+                self.post_id = self.saved_post_id = int(json.load(state)["newest_post_id"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as err:
+            print(f"Ignoring unreadable state file {path} ({str(err)})")
+
+    def advance(self, post_id):
+        """
+        Records that we're done with everything up to and including post_id (in memory only).
+        """
+        self.post_id = max(self.post_id, post_id)
+
+    def save(self):
+        """
+        Writes the mark to the state file if it moved since the last save.
+        """
+        if self.post_id == self.saved_post_id:
+            return
+        post_id = self.post_id
+        _write_json_atomically(self.path, {"newest_post_id": post_id})
+        self.saved_post_id = post_id
+
+
+class Outbox:
+    """
+    Parsed posts waiting to be sent to Discord, oldest first, kept in a SQLite database. Each post
+    is queued up for every destination it goes to (see _make_router). Posts go in before we try to
+    send them and only come out once Discord has them, so nothing is lost if we restart (or give up
+    for now) in between.
+
+    The outbox also keeps its own high-water mark, moved along with every post that goes in, so
+    a post can't have been sent without the mark covering it (see HighWaterMark for the rest).
+    """
+
+    def __init__(self, path=OUTBOX_FILE):
+        # Used from worker threads, one at a time
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " destination TEXT NOT NULL, post TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_destination ON outbox (destination, seq)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS high_water_mark (id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " post_id INTEGER NOT NULL)"
+            )
+
+    def add(self, destinations, post, post_id):
+        """
+        Appends a post to the outbox for each of the destinations (serializing it only once), and
+        moves the high-water mark up to its post_id in the same transaction.
+        """
+        post = json.dumps(post)
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO outbox (destination, post) VALUES (?, ?)",
+                [(destination, post) for destination in destinations],
+            )
+            self.db.execute(
+                "INSERT INTO high_water_mark (id, post_id) VALUES (0, ?) ON CONFLICT (id)"
+                " DO UPDATE SET post_id = max(post_id, excluded.post_id)",
+                (post_id,),
+            )
+
+    def high_water_mark(self):
+        """
+        The ID of the newest post that went into the outbox (0 if there hasn't been one).
+        """
+        with self.lock:
+            row = self.db.execute("SELECT post_id FROM high_water_mark").fetchone()
+        return row[0] if row else 0
+
+    def pending(self, destination, limit):
+        """
+        Returns up to limit of the oldest posts for a destination, as (seq, post) pairs.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT seq, post FROM outbox WHERE destination = ? ORDER BY seq LIMIT ?",
+                (destination, limit),
+            ).fetchall()
+        return [(seq, json.loads(post)) for seq, post in rows]
+
+    def remove(self, seqs):
+        """
+        Takes the posts with the given seqs out of the outbox, once we're done with them.
+        """
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM outbox WHERE seq = ?", [(seq,) for seq in seqs])
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self.lock:
+            self.db.close()
+
+
+async def _checkpoint_worker(high_water_mark, username_cache):
     """
-    The main loop. Retrieves new forum posts every 15 seconds (same as forum spy).
-    If there are any new posts, has them posted to the Discord channel.
+    Periodically saves the high-water mark (and username cache), so we write the state file once
+    per batch of posts.
     """
-    newest_post_id = 0
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        await asyncio.to_thread(high_water_mark.save)
+        await asyncio.to_thread(username_cache.save)
+
+
+async def _fetch_worker(session, parse_queue, newest_post_id, config):
+    """
+    Retrieves the forum spy data every so often (see PollScheduler) and queues up anything
+    newer than the last post we've seen. Never waits on Discord, only on a full parse queue.
+
+    If we're resuming from a saved high-water mark, the first poll queues up everything newer
+    than it that's still in the spy window. Otherwise, the first poll just finds our bearings.
+    """
+    validators = {}
+    scheduler = PollScheduler(config.poll_interval_min, config.poll_interval_max)
     while True:
         try:
             # Request the forum spy data
-            spy_request = urllib.request.Request(FORUM_SPY_AJAX, headers=FORUM_SPY_REQUEST_HEADERS)
-            with urllib.request.urlopen(spy_request) as response:
-                data = json.load(response)
-        except urllib.error.HTTPError as err:
-            # If an HTTP error occurs, wait 30s and try again
-            print(f"While querying forum spy, {err.code}: {err.reason}")
-            time.sleep(30)
+            data = await _get_forum_spy_data(session, validators)
+        except aiohttp.ClientResponseError as err:
+            # If an HTTP error occurs, wait a while and try again
+            print(f"While querying forum spy, {err.status}: {err.message}")
+            await asyncio.sleep(scheduler.failed())
+            continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            # Same for connection problems (e.g. the server dropped a pooled connection)
+            print(f"While querying forum spy, encountered {str(err)}")
+            await asyncio.sleep(scheduler.failed())
             continue
         except json.decoder.JSONDecodeError as err:
-            # If a JSON decode error happens, wait 30s and try again?
+            # If a JSON decode error happens, wait a while and try again?
             print("Empty or malformed JSON returned by forum spy!")
-            time.sleep(30)
+            await asyncio.sleep(scheduler.failed())
             continue
 
+        new_posts = 0
+        if data is None:
+            # Same as last time, so there can't be anything new
+            data = []
         # The first time through the loop, just get the newest post ID
         # (AJAX data is ordered oldest to newest)
-        if not newest_post_id:
+        elif not newest_post_id:
             try:
                 newest_post_id = int(data[-1][0][4:])
             except IndexError:
                 print("No post data returned by forum spy!")
         else:
+            # If even the oldest post in the window is new, we may have missed some in between
+            oldest_post_id = int(data[0][0][4:]) if data else 0
+            if oldest_post_id > newest_post_id + 1:
+                backfilled = await _backfill_posts(
+                    session, newest_post_id + 1, oldest_post_id, config.html_parser
+                )
+                data = backfilled + data
+
             for postdata in data:
-                # Post anything newer than the last thing we posted
+                # Queue anything newer than the last thing we queued
                 post_id = int(postdata[0][4:])
                 if post_id > newest_post_id:
-                    try:
-                        post = _parse_forum_post(postdata)
-                    except Exception as err:  # pylint:disable=broad-except
-                        print(f"While parsing {postdata[0]}, encountered {str(err)}")
-                        continue
-                    _post_in_discord(post)
+                    await parse_queue.put(postdata)
                     newest_post_id = post_id
-                    time.sleep(1)
+                    new_posts += 1
 
         # Wait a while before looking for new posts again
-        time.sleep(15)
+        await asyncio.sleep(scheduler.polled(new_posts, len(data)))
+
+
+async def _parse_worker(  # pylint:disable=too-many-arguments
+    session,
+    parse_queue,
+    outbox,
+    outbox_ready,
+    high_water_mark,
+    username_cache,
+    router,
+    config,
+    executor=None,
+):
+    """
+    Turns queued AJAX data into posts, in order, and puts them in the outbox for the delivery
+    workers of their destinations (see _make_router), setting their events in outbox_ready to wake
+    them up. Each post is parsed once, however many destinations it goes to.
+
+    Parsing is CPU-bound, so it runs in the executor (the default thread pool if there isn't one).
+    With a process pool, up to config.parse_workers posts are parsed at once; whichever finishes
+    first, posts are handed on in the order they were queued in, i.e. by post ID. Posts on excluded
+    boards are spotted from their permalink before parsing (see _peek_permalink) and skipped.
+    """
+    loop = asyncio.get_running_loop()
+    parsing = asyncio.Queue(maxsize=max(config.parse_workers, 1))  # (postdata, future), in order
+
+    async def start_parsing():
+        while True:
+            postdata = await parse_queue.get()
+            url = _peek_permalink(postdata)
+            if url is not None and not router.route(url):
+                # Excluded board: no need to parse it, let alone look up who posted it
+                parsed = None
+            else:
+                parsed = loop.run_in_executor(executor, _parse_forum_post, postdata, config)
+            await parsing.put((postdata, url, parsed))
+
+    async def hand_on():
+        while True:
+            postdata, url, parsed = await parsing.get()
+            try:
+                if parsed is not None:
+                    post = await parsed
+                    await _resolve_username(session, post, config, username_cache)
+                    url = post["url"]
+            except concurrent.futures.BrokenExecutor:
+                # A parse process died (e.g. it ran out of memory), so the pool is no good anymore.
+                # Take the whole process down rather than drop every post from here on.
+                raise
+            except Exception as err:  # pylint:disable=broad-except
+                print(f"While parsing {postdata[0]}, encountered {str(err)}")
+            else:
+                post_id = int(postdata[0][4:])
+                destinations = router.route(url)
+                if not destinations:
+                    print(f"Not posting {url} (excluded board)")
+                else:
+                    # Only what goes into the embed is kept, made once for all the destinations
+                    post = {"id": post["id"], "embed": _embed_data(post)}
+                    await asyncio.to_thread(outbox.add, destinations, post, post_id)
+                    for destination in destinations:
+                        outbox_ready[destination].set()
+                high_water_mark.advance(post_id)
+            finally:
+                parsing.task_done()
+                parse_queue.task_done()
+
+    await asyncio.gather(start_parsing(), hand_on())
+
+
+async def _delivery_worker(session, outbox, destination, webhook, outbox_ready):
+    """
+    Posts the forum posts in the outbox for one destination to its webhook, in order, as fast as
+    the webhook's rate limit allows. Posts waiting next to each other are bundled into one webhook
+    message where they can (see _next_batch). If Discord can't be reached, the posts stay in the
+    outbox and we try again after a while, backing off for as long as it keeps failing.
+
+    Every destination has a worker of its own, so trouble with one webhook never holds up another.
+    """
+    retry_interval = OUTBOX_RETRY_INTERVAL
+    while True:
+        # (cleared first, so we can't miss a post that comes in while we look)
+        outbox_ready.clear()
+        entries = await asyncio.to_thread(outbox.pending, destination, DISCORD_MAX_EMBEDS)
+        if not entries:
+            await outbox_ready.wait()
+            continue
+
+        batch = entries[: _next_batch([post for _, post in entries])]
+        done = await _post_in_discord(session, webhook, [post for _, post in batch])
+        if done:
+            await asyncio.to_thread(outbox.remove, [seq for seq, _ in batch[:done]])
+        if done == len(batch):
+            retry_interval = OUTBOX_RETRY_INTERVAL
+        else:
+            await asyncio.sleep(retry_interval)
+            retry_interval = min(retry_interval * 2, OUTBOX_RETRY_INTERVAL_MAX)
+
+
+async def forum_spy_loop(config):
+    """
+    The main loop. Fetching, parsing and delivery run as separate tasks, connected by a bounded
+    queue and the outbox, so a slow Discord request never holds up the next forum spy poll.
+    Anything left in the outbox from last time goes out first. On a SIGTERM (which is how the
+    dyno gets restarted) everything is cancelled and the state is saved on the way out.
+    """
+    if not config.destinations:
+        for name in ("webhook_url_general", "webhook_url_mafia"):
+            if not getattr(config, name):
+                env_var = CONFIG_SETTINGS[name][1]
+                print(f"ERROR: {name} (environment variable {env_var}) must be set!")
+                return
+    for name, destination in config.destinations.items():
+        if not isinstance(destination, dict) or not destination.get("webhook_url"):
+            print(f"ERROR: destination {name} must have a webhook_url!")
+            return
+    if bs4.builder.builder_registry.lookup(config.html_parser) is None:
+        print(f"ERROR: HTML parser {config.html_parser} is not available (is it installed?)")
+        return
+
+    parse_queue = asyncio.Queue(maxsize=PARSE_QUEUE_SIZE)
+    high_water_mark = HighWaterMark(config.state_file)
+    username_cache = UsernameCache(config.username_cache_file)
+    outbox = Outbox(config.outbox_file)
+    # (the state file trails the outbox's mark if we didn't get to save it on the way out)
+    high_water_mark.advance(outbox.high_water_mark())
+    webhooks = _make_webhooks(config)
+    router = _make_router(config)
+    outbox_ready = {destination: asyncio.Event() for destination in webhooks}
+    executor = (
+        concurrent.futures.ProcessPoolExecutor(max_workers=config.parse_workers)
+        if config.parse_workers > 0
+        else None
+    )
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        async with _forum_session(config) as session, _discord_session(config) as discord_session:
+            # If any stage dies, let the exception take the whole process down (the dyno restarts)
+            await asyncio.gather(
+                _fetch_worker(session, parse_queue, high_water_mark.post_id, config),
+                _parse_worker(
+                    session,
+                    parse_queue,
+                    outbox,
+                    outbox_ready,
+                    high_water_mark,
+                    username_cache,
+                    router,
+                    config,
+                    executor,
+                ),
+                *(
+                    _delivery_worker(
+                        discord_session, outbox, destination, webhook, outbox_ready[destination]
+                    )
+                    for destination, webhook in webhooks.items()
+                ),
+                _checkpoint_worker(high_water_mark, username_cache),
+            )
+    except asyncio.CancelledError:
+        print("Shutting down")
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        high_water_mark.save()
+        username_cache.save()
+        outbox.close()
 
 
 if __name__ == "__main__":
-    forum_spy_loop()
+    try:
+        CONFIG = Config.load(os.getenv("FORUM_SPY_CONFIG_FILE"))
+    except (ValueError, OSError) as err:
+        print(f"ERROR: Couldn't load the config ({str(err)})")
+        sys.exit()
+    asyncio.run(forum_spy_loop(CONFIG))
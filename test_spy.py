@@ -4,47 +4,120 @@ find and address odd edge cases.
 """
 # pylint:disable=protected-access
 import argparse
+import asyncio
 import json
 import os
+import subprocess
+import sys
 import time
 import urllib.request
 
-from bs4 import BeautifulSoup
-
 import forum_spy
 
 
 # for now, not committed to the repo; generated and used locally only
 TEST_DATA_FILE = "test_data.ajax"
+# How long (in seconds) importing forum_spy may take. Heavy dependencies are imported lazily, so
+# this should only cover the standard library modules it uses.
+IMPORT_TIME_BUDGET = 0.1
 
 
-def make_forum_post_ajax(post_id):
+def make_forum_post_ajax(post_id, config):
     """
     Queries for a post with a given ID number (int) and generates the AJAX data for it,
     as if it were returned from the forum spy AJAX request.
     """
     message_url = f"{forum_spy.FORUM_ROOT}/forum/message/{post_id}"
     try:
-        post_request = urllib.request.Request(
-            message_url, headers=forum_spy.FORUM_SPY_REQUEST_HEADERS
-        )
+        # (urllib doesn't decompress responses, so don't ask for them compressed)
+        headers = dict(forum_spy.FORUM_SPY_REQUEST_HEADERS)
+        del headers["Accept-Encoding"]
+        post_request = urllib.request.Request(message_url, headers=headers)
         with urllib.request.urlopen(post_request) as response:
             data = response.read()
     except urllib.error.HTTPError as err:
         print(f"While querying {message_url}, {err.code}: {err.reason}")
         return None
 
-    soup = BeautifulSoup(data, "html.parser")
-    id_str = f"post{post_id}"
-    post_html = str(soup.find("div", {"id": id_str}))
+    return forum_spy._post_ajax_from_page(data, post_id, config.html_parser)
+
+
+async def parse_test_data(test_data, config):
+    """
+    Runs the parser over the test data (including any username lookups) and returns the posts.
+    """
+    async with forum_spy._forum_session(config) as session:
+        return [
+            await forum_spy._resolve_username(
+                session, forum_spy._parse_forum_post(post_data, config), config
+            )
+            for post_data in test_data
+        ]
+
+
+async def post_test_data(posts, config):
+    """
+    Posts the parsed test posts to Discord, one at a time, wherever the bot would post them.
+    """
+    webhooks = forum_spy._make_webhooks(config)
+    router = forum_spy._make_router(config)
+    async with forum_spy._discord_session(config) as session:
+        for post in posts:
+            destinations = router.route(post["url"])
+            if not destinations:
+                print(f"Not posting {post['url']} (excluded board)")
+            for destination in sorted(destinations):
+                await forum_spy._post_in_discord(session, webhooks[destination], [post])
+
 
-    return [id_str, post_html]
+def compare_parsers(test_data, config):
+    """
+    Parses the test data with each installed parser backend, and reports any posts whose embed
+    text comes out different from what Python's built-in html.parser produces, or whose permalink
+    the quick scan used for routing (_peek_permalink) gets wrong.
+    """
+    builder_registry = forum_spy.bs4.builder.builder_registry
+    parsers = [p for p in ("lxml", "html5lib") if builder_registry.lookup(p) is not None]
+    reference = config.html_parser
+    try:
+        config.html_parser = "html.parser"
+        expected = []
+        for post_data in test_data:
+            post = forum_spy._parse_forum_post(post_data, config)
+            if forum_spy._peek_permalink(post_data) != post["url"]:
+                print(f"{post_data[0]}: permalink scan doesn't match {post['url']}")
+            expected.append(post["text"])
+        for parser in parsers:
+            config.html_parser = parser
+            for post_data, text in zip(test_data, expected):
+                if forum_spy._parse_forum_post(post_data, config)["text"] != text:
+                    print(f"{parser}: {post_data[0]} differs from html.parser")
+            print(f"Compared {parser} against html.parser on {len(test_data)} posts")
+    finally:
+        config.html_parser = reference
+
+
+def check_import_time():
+    """
+    Measures how long importing forum_spy takes in a fresh interpreter (best of a few runs, to
+    keep the noise down), and reports whether it's within IMPORT_TIME_BUDGET.
+    """
+    measure = "import time; t = time.perf_counter(); import forum_spy; print(time.perf_counter()-t)"
+    import_times = []
+    for _ in range(5):
+        result = subprocess.run([sys.executable, "-c", measure], capture_output=True, check=True)
+        import_times.append(float(result.stdout))
+    import_time = min(import_times)
+    verdict = "within" if import_time <= IMPORT_TIME_BUDGET else "OVER"
+    print(f"Importing forum_spy took {import_time:.3f}s ({verdict} {IMPORT_TIME_BUDGET}s budget)")
 
 
 def main(args):
     """
     Run the parser agaist the test set
     """
+    config = forum_spy.Config.load(args.config or os.getenv("FORUM_SPY_CONFIG_FILE"))
+
     # load the test data
     test_data = []
     if os.path.isfile(TEST_DATA_FILE):
@@ -57,7 +130,11 @@ def main(args):
             test_data = []
         if args.add_post:
             for post_id in args.add_post:
-                test_data.append(make_forum_post_ajax(post_id))
+                post_data = make_forum_post_ajax(post_id, config)
+                if post_data is None:
+                    print(f"Couldn't add post {post_id}")
+                else:
+                    test_data.append(post_data)
                 time.sleep(0.5)
         if args.delete_post:
             test_data = [p for p in test_data if int(p[0][4:]) not in args.delete_post]
@@ -65,14 +142,18 @@ def main(args):
         with open(TEST_DATA_FILE, "w") as ajax:
             json.dump(test_data, ajax)
 
+    if args.compare_parsers:
+        compare_parsers(test_data, config)
+
+    if args.import_time:
+        check_import_time()
+
     # test the parser against the test data
     if args.test or args.post:
-        for post_data in test_data:
-            post = forum_spy._parse_forum_post(post_data)
-            # post to discord if instructed
-            if args.post:
-                forum_spy._post_in_discord(post)
-                time.sleep(1)
+        posts = asyncio.run(parse_test_data(test_data, config))
+        # post to discord if instructed
+        if args.post:
+            asyncio.run(post_test_data(posts, config))
 
 
 if __name__ == "__main__":
@@ -107,6 +188,22 @@ if __name__ == "__main__":
         action="store_true",
         help="Post the embed data to Discord (WARNING: ensure you are using a test webhook!)",
     )
+    parser.add_argument(
+        "--compare-parsers",
+        action="store_true",
+        help="Check that every installed HTML parser backend gives the same embed text",
+    )
+    parser.add_argument(
+        "--import-time",
+        action="store_true",
+        help="Check that importing forum_spy stays within its import time budget",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        required=False,
+        help="TOML config file to use (default: $FORUM_SPY_CONFIG_FILE, if set)",
+    )
     parser.add_argument(
         "--clear",
         action="store_true",